@@ -2,6 +2,23 @@ import ply.lex as lex
 import ply.yacc as yacc
 import sys
 import random
+import operator
+import re
+import itertools
+import threading
+import getopt
+import json
+import zlib
+import array
+import time
+import hashlib
+import os
+import inspect
+import keyword
+import __builtin__
+import py_compile
+import imp
+import resource
 
 STR_LITERAL = ''
 
@@ -31,6 +48,8 @@ tokens = [
     'NUMBER',
     'ARROWL',
     'ARROWR',
+    'BRACKETL',
+    'BRACKETR',
     'PARENL',
     'PARENR',
     'COMMA',
@@ -46,6 +65,8 @@ tokens = [
 
 t_ARROWL = r'<\-'
 t_ARROWR = r'\->'
+t_BRACKETL = r'\['
+t_BRACKETR = r'\]'
 t_COMMA = r','
 t_DIVIDE = r'/'
 t_EQUAL = r'='
@@ -67,8 +88,9 @@ def t_ID(t):
     return t
 
 def t_NEWLINE(t):
-    r'\n+'
-    t.lexer.lineno += len(t.value)
+    r'\n([ \t]*\n)*'
+    ## lines of only spaces are blank lines too
+    t.lexer.lineno += t.value.count('\n')
     return t
 
 def t_DBLQUOTE(t):
@@ -79,7 +101,12 @@ def t_DBLQUOTE(t):
     return None
 
 
-t_ignore_COMMENT = r'\#\# .*(\r\n|\n|\r)'
+def t_COMMENT(t):
+    r'\#\# .*(\r\n|\n|\r)'
+    ## the comment swallows its newline, but the line still counts
+    t.lexer.lineno += 1
+    return None
+
 t_ignore = ' \t'
 
 def t_error(t):
@@ -140,11 +167,14 @@ class BinaryExpr:
     def __init__(self, op1, op2):
         self.op1 = op1
         self.op2 = op2
+        self.fused = None
 
     def evaluate(self, prog):
-        val1 = self.op1.evaluate(prog)
-        val2 = self.op2.evaluate(prog)
-        return self.operate(val1, val2)
+        ## compiled on first use, so nested operators are never compiled
+        ## on their own
+        if self.fused is None:
+            self.fused = FusedExpr(self)
+        return self.fused.evaluate(prog)
 
     def __repr__(self):
         op1_str = str(self.op1)
@@ -152,33 +182,105 @@ class BinaryExpr:
         return "%s %s %s" % (op1_str, self.operator_string(), op2_str)
 
 class AddExpr(BinaryExpr):
-    def operate(self, a, b):
-        return a + b
+    python_operator = '+'
 
     def operator_string(self):
         return '+'
 
 class MultExpr(BinaryExpr):
-    def operate(self, a, b):
-        return a * b
+    python_operator = '*'
 
     def operator_string(self):
         return '*'
 
 class DivideExpr(BinaryExpr):
-    def operate(self, a, b):
-        return a / b
+    python_operator = '/'
 
     def operator_string(self):
         return '/'
 
 class EqualExpr(BinaryExpr):
-    def operate(self, a, b):
-        return a == b
+    python_operator = '=='
 
     def operator_string(self):
         return '='
 
+class FusedExpr:
+    """A tree of operators compiled into Python code
+
+    Every node of the tree that isn't an operator or a negation is a
+    leaf. With only scalar leaves the tree is one compiled expression.
+    When some leaves are Vectors, the tree is compiled into a single
+    list comprehension over those vectors, so an expression like
+    a * b + c makes one pass and builds no intermediate vectors. The
+    code for each pattern of vector and scalar leaves is compiled once.
+    """
+    def __init__(self, root):
+        self.leaves = []
+        self.source = self._source(root)
+        self.is_equal = isinstance(root, EqualExpr)
+        self.compiled = dict()
+        self.scalar = self._compile(())
+
+    def _source(self, node):
+        if isinstance(node, BinaryExpr):
+            return "(%s %s %s)" % (self._source(node.op1)
+                , node.python_operator, self._source(node.op2))
+        if isinstance(node, NegativeTerm):
+            return "(-%s)" % self._source(node.x)
+        self.leaves.append(node)
+        return "a%d" % (len(self.leaves) - 1)
+
+    def _compile(self, vectors):
+        "Compile for the leaves at the positions in vectors being vectors"
+        args = ", ".join("a%d" % i for i in xrange(len(self.leaves)))
+        if not vectors:
+            return eval("lambda %s: %s" % (args, self.source))
+        body = self.source
+        for i in vectors:
+            body = re.sub(r'\ba%d\b' % i, 'x%d' % i, body)
+        items = ", ".join("x%d" % i for i in vectors)
+        if len(vectors) == 1:
+            loop = "for %s in a%d" % (items, vectors[0])
+        else:
+            loop = "for %s in izip(%s)" % (items
+                , ", ".join("a%d" % i for i in vectors))
+        return eval("lambda %s: [%s %s]" % (args, body, loop)
+            , {'izip': itertools.izip})
+
+    def evaluate(self, prog):
+        values = [l.evaluate(prog) for l in self.leaves]
+        vectors = []
+        size = None
+        i = 0
+        for v in values:
+            if v.__class__ is Vector:
+                if size is None:
+                    size = len(v.items)
+                elif len(v.items) != size:
+                    raise Exception("vector length mismatch: %d and %d"
+                        % (size, len(v.items)))
+                vectors.append(i)
+                values[i] = v.items
+            i += 1
+        if size is None:
+            return self.scalar(*values)
+
+        vectors = tuple(vectors)
+        function = self.compiled.get(vectors)
+        if function is None:
+            function = self._compile(vectors)
+            self.compiled[vectors] = function
+        items = function(*values)
+        like = values[vectors[0]]
+        if not self.is_equal and isinstance(like, array.array):
+            ## arithmetic on an array usually stays the same type
+            try:
+                return Vector.from_array(array.array(like.typecode, items))
+            except (TypeError, OverflowError):
+                pass
+        return Vector(items)
+
 class NegativeTerm:
     def __init__(self, op):
         self.x = op
@@ -189,12 +291,129 @@ class NegativeTerm:
     def __repr__(self):
         return "-%s" % str(self.x)
 
+class ListExpr:
+    def __init__(self, items):
+        self.items = items
+
+    def evaluate(self, prog):
+        return Vector([i.evaluate(prog) for i in self.items])
+
+    def __repr__(self):
+        return "[%s]" % ", ".join(str(i) for i in self.items)
+
+class IndexExpr:
+    def __init__(self, list, index):
+        self.list = list
+        self.index = index
+
+    def evaluate(self, prog):
+        return self.list.evaluate(prog)[self.index.evaluate(prog)]
+
+    def __repr__(self):
+        return "%s[%s]" % (self.list, self.index)
+
+
+class Vector:
+    """A list value
+
+    Items are kept in a typed array when they are all numbers of the same
+    type. Arithmetic with a vector applies element-wise, with a scalar
+    operand applied to every element, and is done with one map over the
+    arrays rather than evaluating the expression once per element.
+    Comparing vectors with = gives a vector of results, which is only
+    true if every element matched.
+    """
+    def __init__(self, items):
+        self.items = make_column(items)
+
+    @staticmethod
+    def combine(function, a, b):
+        if a.__class__ is Vector and b.__class__ is Vector:
+            if len(a.items) != len(b.items):
+                raise Exception("vector length mismatch: %d and %d"
+                    % (len(a.items), len(b.items)))
+            items = map(function, a.items, b.items)
+            like = a.items
+        elif a.__class__ is Vector:
+            items = map(function, a.items, [b] * len(a.items))
+            like = a.items
+        else:
+            items = map(function, [a] * len(b.items), b.items)
+            like = b.items
+        if function is not operator.eq and isinstance(like, array.array):
+            ## arithmetic on an array usually stays the same type
+            try:
+                return Vector.from_array(array.array(like.typecode, items))
+            except (TypeError, OverflowError):
+                pass
+        return Vector(items)
+
+    @staticmethod
+    def from_array(items):
+        v = Vector([])
+        v.items = items
+        return v
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __neg__(self):
+        return Vector.combine(operator.mul, self, -1)
+
+    ## so modules made by PythonBuilder can use plain operators
+    def __add__(self, other):
+        return Vector.combine(operator.add, self, other)
+
+    def __radd__(self, other):
+        return Vector.combine(operator.add, other, self)
+
+    def __mul__(self, other):
+        return Vector.combine(operator.mul, self, other)
+
+    def __rmul__(self, other):
+        return Vector.combine(operator.mul, other, self)
+
+    def __div__(self, other):
+        return Vector.combine(operator.div, self, other)
+
+    def __rdiv__(self, other):
+        return Vector.combine(operator.div, other, self)
+
+    def __nonzero__(self):
+        return all(self.items)
+
+    def __eq__(self, other):
+        if other.__class__ is not Vector:
+            return False
+        return list(self.items) == list(other.items)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self.items))
+
+def vector_eq(a, b):
+    "= for modules made by PythonBuilder, element-wise like the interpreter"
+    if a.__class__ is Vector or b.__class__ is Vector:
+        return Vector.combine(operator.eq, a, b)
+    return a == b
+
 
 class FunctionDef:
     def __init__(self, id, args, stmts):
         self.name = id
         self.args = args
         self.code = stmts
+        ## filled in by EffectAnalysis
+        self.effect = None
+        self.reachable = None
 
     def __repr__(self):
         r = "func:%s(" % self.name
@@ -224,7 +443,13 @@ class Assignment:
     def __repr__(self):
         return "%s <- %s" % (self.dst, self.src)
 
-class AssignStmt:
+class Statement:
+    ## source line, set by the parser
+    lineno = None
+    ## index into the coverage counters, set by Program
+    sid = None
+
+class AssignStmt(Statement):
     def __init__(self, assignment):
         self.dst = assignment.dst
         self.src = assignment.src
@@ -234,19 +459,24 @@ class AssignStmt:
 
     def execute(self, prog):
         val = self.src.evaluate(prog)
-        ## cast val to a list if it is not already
+        ## a single name keeps any value whole, several names unpack it
+        if len(self.dst) == 1:
+            prog.set_local(self.dst[0], val)
+            return
+        if isinstance(val, (Vector, TestDataSet)):
+            val = list(val)
         if not isinstance(val, list):
             val = [val]
         num_values = len(val)
         if num_values != len(self.dst):
-            print 'mismatched assignment'
-            exit(1)
+            raise Exception("mismatched assignment: %d values for %d names"
+                % (num_values, len(self.dst)))
         i = 0
         while i < num_values:
             prog.set_local(self.dst[i], val[i])
             i += 1
 
-class GivenStmt:
+class GivenStmt(Statement):
     def __init__(self, assignment):
         self.dst = assignment.dst
         self.src = assignment.src
@@ -256,32 +486,28 @@ class GivenStmt:
 
     def permute(self, cases, prog):
         values = self.src.evaluate(prog)
-        named_values = self.name_values(self.dst, values)
-        result = self.outer_join(cases, named_values)
+        if not isinstance(values, TestDataSet):
+            values = TestDataSet.from_rows(values)
+        bound = self.bind(self.dst, values)
+        result = self.outer_join(cases, bound)
         return result
 
     @staticmethod
-    def name_values(ids, indexed_values):
-        named = list()
+    def bind(ids, data):
+        "Make a case for each row of data that has one value per id"
         id_count = len(ids)
-        for row in indexed_values:
-            if not isinstance(row, list):
-                row = [row]
-
-            rowsize = len(row)
+        binding = (ids, data.columns)
+        cases = list()
+        for i in xrange(len(data)):
+            rowsize = data.width(i)
             if rowsize < id_count:
-                print "not enough values: %s" % row
+                print "not enough values: %s" % data.row(i)
                 continue
             elif rowsize > id_count:
-                print "too many values: %s" % row
+                print "too many values: %s" % data.row(i)
                 continue
-            i = 0
-            named_row = dict()
-            while i < id_count:
-                named_row[ids[i]] = row[i]
-                i += 1
-            named.append(named_row)
-        return named
+            cases.append(Case((binding + (i,),)))
+        return cases
 
     @staticmethod
     def outer_join(caselist1, caselist2):
@@ -293,16 +519,34 @@ class GivenStmt:
         cases = list()
         for c1 in caselist1:
             for c2 in caselist2:
-                newcase = dict()
-                for name,value in c1.items():
-                    newcase[name] = value
-                for name,value in c2.items():
-                    newcase[name] = value
-                cases.append(newcase)
+                cases.append(Case(c1 + c2))
         return cases
 
+class Case(tuple):
+    """Given values for one run of a test
+
+    Each item is an (ids, columns, row) binding into a TestDataSet, so
+    the values stay in their columns until the test runs.
+    """
+    def bind(self, prog):
+        for ids, columns, row in self:
+            i = 0
+            for name in ids:
+                prog.set_local(name, columns[i][row])
+                i += 1
+
+    def values(self):
+        named = dict()
+        for ids, columns, row in self:
+            for name, column in zip(ids, columns):
+                named[name] = column[row]
+        return named
+
+    def __repr__(self):
+        return repr(self.values())
+
 
-class ReturnStmt:
+class ReturnStmt(Statement):
     def __init__(self, expr):
         self.expr = expr
 
@@ -313,7 +557,7 @@ class ReturnStmt:
     def __repr__(self):
         return "return %s" % (self.expr)
 
-class AssertionStmt:
+class AssertionStmt(Statement):
     def __init__(self, expr):
         self.expr = expr
 
@@ -371,6 +615,13 @@ class AssertionFailure(Exception):
 class NoAssertionFailure(AssertionFailure):
     pass
 
+class MergeError(Exception):
+    pass
+
+class BudgetExceeded(Exception):
+    "A test case did more work than its Budget allows"
+    pass
+
 
 class TestDef:
     pass
@@ -380,24 +631,50 @@ class PureTestDef(TestDef):
         self.function = id
         self.cases = cases
 
-    def run(self, prog):
+    def test_name(self):
+        return "puretest %s" % self.function
+
+    def run(self, prog, results):
         print "puretest: %s" % (self.function)
-        for values in self.cases:
-            args = [a.evaluate(prog) for a in values[0:-1]]
-            result = values[-1].evaluate(prog)
+        name = self.test_name()
+        prog.begin_test(name)
+        for index, values in enumerate(self.cases):
+            if not results.includes(name, index):
+                continue
+            values = evaluate_row(values, prog)
+            args = values[0:-1]
+            result = values[-1]
+            prog.begin_case(name, index, {'args': args})
             try:
                 actual = prog.call_function(self.function, args)
+            except BudgetExceeded, b:
+                sys.stdout.write('T')
+                results.record(name, index, 'T', str(b))
+                continue
+            except MemoryError:
+                ## the traceback would keep the allocations alive
+                sys.exc_clear()
+                sys.stdout.write('M')
+                results.record(name, index, 'M', 'out of memory')
+                continue
             except Exception, e:
                 sys.stdout.write('E')
                 sys.stderr.write(str(e))
+                results.record(name, index, 'E', str(e))
                 continue
+            finally:
+                prog.end_case(name, index)
 
             if result == actual:
                 sys.stdout.write('.')
+                results.record(name, index, '.')
             else:
                 sys.stdout.write('\nF ')
-                print('%s(%s) != %s(%s)' % (result.__class__.__name__, result
-                    , actual.__class__.__name__, actual))
+                detail = '%s(%s) != %s(%s)' % (result.__class__.__name__
+                    , result, actual.__class__.__name__, actual)
+                print(detail)
+                results.record(name, index, 'F', detail)
+        prog.end_test(name)
         print ''
 
 class PureFailureDef(TestDef):
@@ -406,15 +683,35 @@ class PureFailureDef(TestDef):
         self.function = id
         self.cases = cases
 
-    def run(self, prog):
+    def test_name(self):
+        return "purefail %s" % self.function
+
+    def run(self, prog, results):
         print "purefailure: %s" % (self.function)
-        for values in self.cases:
-            args = [a.evaluate(prog) for a in values]
+        name = self.test_name()
+        prog.begin_test(name)
+        for index, values in enumerate(self.cases):
+            if not results.includes(name, index):
+                continue
+            args = evaluate_row(values, prog)
+            prog.begin_case(name, index, {'args': args})
             try:
                 actual = prog.call_function(self.function, args)
                 sys.stdout.write('F')
+                results.record(name, index, 'F', 'returned %s' % (actual,))
+            except BudgetExceeded, b:
+                sys.stdout.write('T')
+                results.record(name, index, 'T', str(b))
+            except MemoryError:
+                sys.exc_clear()
+                sys.stdout.write('M')
+                results.record(name, index, 'M', 'out of memory')
             except Exception, e:
                 sys.stdout.write('.')
+                results.record(name, index, '.')
+            finally:
+                prog.end_case(name, index)
+        prog.end_test(name)
         print ''
 
 class RegularTestDef(TestDef):
@@ -422,36 +719,267 @@ class RegularTestDef(TestDef):
         self.name = id
         self.givens = givens
         self.code = code
-        self.cases = []
 
-    def run(self, prog):
-        print "test: %s" % (self.name)
-        for g in self.givens:
-            self.cases = g.permute(self.cases, prog)
+    def test_name(self):
+        return self.name
 
-        if len(self.cases) == 0:
-            self.cases = [{}]
-        for c in self.cases:
+    def run(self, prog, results):
+        print "test: %s" % (self.name)
+        prog.begin_test(self.name)
+        cases = []
+        prog.start_case()
+        try:
+            for g in self.givens:
+                prog.count(g)
+                cases = g.permute(cases, prog)
+        except (BudgetExceeded, MemoryError), e:
+            outcome = 'T' if isinstance(e, BudgetExceeded) else 'M'
+            sys.exc_clear()
+            print "%s %s in givens" % (outcome, e)
+            if results.includes(self.name, 0):
+                results.record(self.name, 0, outcome, "%s in givens" % e)
+            prog.end_test(self.name)
+            return
+
+        if len(cases) == 0:
+            cases = [Case()]
+        for index, c in enumerate(cases):
+            if not results.includes(self.name, index):
+                continue
             #print "run test: %s w/ %s" % (self.name, c)
+            prog.begin_case(self.name, index, c)
             try:
                 prog.run_test(self, c)
                 sys.stdout.write('.')
+                results.record(self.name, index, '.')
             except AssertionFailure, a:
                 print "F %s for %s" % (a, c)
+                results.record(self.name, index, 'F', "%s for %s" % (a, c))
+            except BudgetExceeded, b:
+                print "T %s for %s" % (b, c)
+                results.record(self.name, index, 'T', "%s for %s" % (b, c))
+            except MemoryError:
+                sys.exc_clear()
+                print "M out of memory for %s" % (c,)
+                results.record(self.name, index, 'M'
+                    , "out of memory for %s" % (c,))
             except Exception, e:
                 print "E %s for %s" % (e, c)
+                results.record(self.name, index, 'E', "%s for %s" % (e, c))
+            finally:
+                prog.end_case(self.name, index)
+        prog.end_test(self.name)
         sys.stdout.write('\n')
 
+
+class Shard:
+    """One of n disjoint slices of the test cases in a program
+
+    Cases are assigned by hashing the test name and case index, so every
+    machine agrees on the split without talking to each other.
+    """
+    def __init__(self, index, count):
+        if count < 1 or index < 0 or index >= count:
+            raise ValueError("invalid shard %d/%d" % (index, count))
+        self.index = index
+        self.count = count
+
+    @staticmethod
+    def parse(spec):
+        "Parse a shard spec of the form i/n, counting from 0"
+        try:
+            index, count = spec.split('/')
+            index = int(index)
+            count = int(count)
+        except (ValueError, AttributeError):
+            raise ValueError("shard must be i/n, got %s" % spec)
+        return Shard(index, count)
+
+    def includes(self, test, case):
+        key = "%s/%d" % (test, case)
+        return (zlib.crc32(key) & 0xffffffff) % self.count == self.index
+
+    def __repr__(self):
+        return "%d/%d" % (self.index, self.count)
+
+class TestResults:
+    """Outcome of each test case that ran
+
+    Outcomes are '.' for a pass, 'F' for a failed assertion, 'E' for an
+    error, 'T' for a case over its Budget and 'M' for running out of
+    memory.
+    """
+    def __init__(self, shard=None):
+        self.shard = shard
+        self.outcomes = []
+
+    def includes(self, test, case):
+        return self.shard is None or self.shard.includes(test, case)
+
+    def record(self, test, case, outcome, detail=None):
+        self.outcomes.append((test, case, outcome, detail))
+
+    def failed(self):
+        for o in self.outcomes:
+            if o[2] != '.':
+                return True
+        return False
+
+    def save(self, filename):
+        shard = None if self.shard is None else str(self.shard)
+        with open(filename, 'w') as f:
+            json.dump({'shard': shard, 'outcomes': self.outcomes}, f)
+
+    @staticmethod
+    def merge(filenames):
+        """Combine the saved results of several shards
+
+        The files must hold every shard of one split exactly once, or a
+        single unsharded run, otherwise this raises a MergeError.
+        """
+        merged = TestResults()
+        saved = [TestResults.read(filename) for filename in filenames]
+        TestResults.check_shards([shard for shard, outcomes in saved])
+        for shard, outcomes in saved:
+            for test, case, outcome, detail in outcomes:
+                merged.record(test, case, outcome, detail)
+        merged.outcomes.sort(key=lambda o: (o[0], o[1]))
+        return merged
+
+    @staticmethod
+    def read(filename):
+        "Read the shard spec and outcomes from a saved results file"
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+            outcomes = [tuple(o) for o in data['outcomes']]
+            if [o for o in outcomes if len(o) != 4]:
+                raise ValueError("malformed outcome")
+            return (data['shard'], outcomes)
+        except IOError, e:
+            raise MergeError("can't read %s: %s" % (filename, e.strerror))
+        except (ValueError, KeyError, TypeError), e:
+            raise MergeError("%s is not a results file: %s" % (filename, e))
+
+    @staticmethod
+    def check_shards(specs):
+        if None in specs:
+            if len(specs) != 1:
+                raise MergeError("an unsharded run can't be merged with others")
+            return
+        try:
+            shards = [Shard.parse(s) for s in specs]
+        except ValueError, e:
+            raise MergeError("bad shard in results: %s" % e)
+        count = shards[0].count
+        if [s for s in shards if s.count != count]:
+            raise MergeError("shards are from different splits: %s"
+                % ", ".join(specs))
+        indexes = sorted(s.index for s in shards)
+        if indexes != range(count):
+            missing = sorted(set(range(count)) - set(indexes))
+            repeated = sorted(set(i for i in indexes if indexes.count(i) > 1))
+            raise MergeError("expected shards 0..%d once each, missing %s"
+                ", repeated %s" % (count - 1, missing, repeated))
+
+    def report(self):
+        counts = dict()
+        for test, case, outcome, detail in self.outcomes:
+            if outcome != '.':
+                print "%s %s[%d]: %s" % (outcome, test, case, detail)
+            counts[outcome] = counts.get(outcome, 0) + 1
+        print "%d cases: %d passed, %d failed, %d errors" % (len(self.outcomes)
+            , counts.get('.', 0), counts.get('F', 0), counts.get('E', 0))
+        if counts.get('T', 0) or counts.get('M', 0):
+            print "%d over budget, %d out of memory" % (counts.get('T', 0)
+                , counts.get('M', 0))
+
 class TestDataDef:
     def __init__(self, id, provisions):
         self.name = id
         self.data = provisions
+        ## the whole data set, when every row is constant
+        self.constant = None
 
     def evaluate(self, program):
-        data = list()
+        return program.dataset(self)
+
+    def materialize(self, program):
+        if self.constant is not None:
+            return self.constant
+        rows = list()
         for row in self.data:
-            data.append([v.evaluate(program) for v in row])
-        return data
+            rows.append(evaluate_row(row, program))
+        return TestDataSet.from_rows(rows)
+
+class ConstRow(tuple):
+    "A table row of literal values, loaded without building AST nodes"
+    pass
+
+def evaluate_row(row, prog):
+    if isinstance(row, ConstRow):
+        return list(row)
+    return [v.evaluate(prog) for v in row]
+
+def make_column(values):
+    "Store values in an array if they are all numbers of one type"
+    types = set(type(v) for v in values)
+    if types == set([int]) or types == set([int, long]):
+        try:
+            return array.array('l', values)
+        except OverflowError:
+            return list(values)
+    if types == set([float]):
+        return array.array('d', values)
+    if types == set([str]):
+        return [intern(v) for v in values]
+    return list(values)
+
+class TestDataSet:
+    """Rows of test data stored as one column per position
+
+    Rows shorter than the widest row are padded with None in the columns
+    they lack, and their real width is kept in widths.
+    """
+    def __init__(self, columns, size, widths=None):
+        self.columns = columns
+        self.size = size
+        self.widths = widths
+
+    @staticmethod
+    def from_rows(rows):
+        rows = [list(r) if isinstance(r, (list, Vector)) else [r]
+            for r in rows]
+        widths = array.array('l', [len(r) for r in rows])
+        width = max(widths) if rows else 0
+        columns = list()
+        for i in xrange(width):
+            columns.append(make_column(
+                [r[i] if i < len(r) else None for r in rows]))
+        if min(widths or [width]) == width:
+            widths = None
+        return TestDataSet(columns, len(rows), widths)
+
+    def width(self, i):
+        if self.widths is None:
+            return len(self.columns)
+        return self.widths[i]
+
+    def row(self, i):
+        return [c[i] for c in self.columns[:self.width(i)]]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if i < 0 or i >= self.size:
+            raise IndexError(i)
+        return Vector(self.row(i))
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 
@@ -510,6 +1038,7 @@ def p_code_more(p):
 def p_stmteol(p):
     'stmteol : stmt NEWLINE'
     p[0] = p[1]
+    p[0].lineno = p.lineno(2)
 
 def p_stmt_assign(p):
     'stmt : assignment'
@@ -564,10 +1093,12 @@ def p_optgivens(p):
 
 def p_givens_first(p):
     'givens : given NEWLINE'
+    p[1].lineno = p.lineno(2)
     p[0] = [p[1]]
 
 def p_givens_more(p):
     'givens : givens given NEWLINE'
+    p[2].lineno = p.lineno(3)
     p[0] = p[1]
     p[0].append(p[2])
 
@@ -577,10 +1108,12 @@ def p_given(p):
 
 def p_testcode(p):
     'testcode : teststmt NEWLINE'
+    p[1].lineno = p.lineno(2)
     p[0] = [p[1]]
 
 def p_testcode_more(p):
     'testcode : testcode teststmt NEWLINE'
+    p[2].lineno = p.lineno(3)
     p[0] = p[1]
     p[0].append(p[2])
 
@@ -688,20 +1221,34 @@ def p_expr_equal(p):
 
 
 ## Terms
-def p_term_parened(p):
-    'term : PARENL expr PARENR'
+def p_term_indexable(p):
+    'term : indexable'
+    p[0] = p[1]
+
+## only names, calls and parenthesized expressions can be indexed, so a
+## list literal after another term in a testdata row starts a new value
+def p_indexable_parened(p):
+    'indexable : PARENL expr PARENR'
     p[0] = p[2]
 
 def p_term_negation(p):
     'term : MINUS term'
     p[0] = NegativeTerm(p[2])
 
-def p_term_functioncall(p):
-    'expr : functioncall'
+def p_term_list(p):
+    'term : BRACKETL optcallargs BRACKETR'
+    p[0] = ListExpr(p[2])
+
+def p_indexable_index(p):
+    'indexable : indexable BRACKETL expr BRACKETR'
+    p[0] = IndexExpr(p[1], p[3])
+
+def p_indexable_functioncall(p):
+    'indexable : functioncall'
     p[0] = p[1]
 
-def p_term_id(p):
-    'term : ID'
+def p_indexable_id(p):
+    'indexable : ID'
     p[0] = VarExpr(p[1])
 
 def p_term_number(p):
@@ -722,7 +1269,10 @@ def builtin_generate(cnt, f):
     while (cnt > 0):
         result.append(f())
         cnt -= 1
-    return result
+    return Vector(result)
+
+def builtin_len(val):
+    return len(val)
 
 def builtin_print(val):
     print val
@@ -731,6 +1281,231 @@ def builtin_random_int():
     return random.randint(-100, 100)
 
 
+PURE = 'pure'
+NONDETERMINISTIC = 'nondeterministic'
+EFFECTFUL = 'effectful'
+EFFECT_ORDER = [PURE, NONDETERMINISTIC, EFFECTFUL]
+
+## effects of the builtins themselves, before looking at anything they call
+## builtins missing from this table are assumed to be effectful
+BUILTIN_EFFECTS = {
+    'generate': PURE,
+    'len': PURE,
+    'print': EFFECTFUL,
+    'random_int': NONDETERMINISTIC,
+}
+
+## steps charged to a Budget for builtins that do more than one step of work
+BUILTIN_COSTS = {
+    'generate': lambda cnt, f: max(0, cnt),
+}
+
+
+def child_nodes(node):
+    "List the AST nodes directly beneath a node"
+    if isinstance(node, list):
+        return node
+    if isinstance(node, FunctionCall):
+        return node.args
+    if isinstance(node, BinaryExpr):
+        return [node.op1, node.op2]
+    if isinstance(node, NegativeTerm):
+        return [node.x]
+    if isinstance(node, ListExpr):
+        return node.items
+    if isinstance(node, IndexExpr):
+        return [node.list, node.index]
+    if isinstance(node, (AssignStmt, GivenStmt)):
+        return [node.src]
+    if isinstance(node, (ReturnStmt, AssertionStmt)):
+        return [node.expr]
+    if isinstance(node, FunctionDef):
+        return node.code
+    if isinstance(node, RegularTestDef):
+        return node.givens + node.code
+    if isinstance(node, (PureTestDef, PureFailureDef)):
+        return node.cases
+    if isinstance(node, TestDataDef):
+        return node.data
+    return []
+
+def references(node):
+    """Collect the names referenced anywhere beneath an AST node
+
+    Variables are included along with calls because functions can be
+    passed by name, as in generate(10, random_int).
+    """
+    names = set()
+    pending = [node]
+    while pending:
+        n = pending.pop()
+        if isinstance(n, (FunctionCall, VarExpr)):
+            names.add(n.name)
+        elif isinstance(n, (PureTestDef, PureFailureDef)):
+            names.add(n.function)
+        pending.extend(child_nodes(n))
+    return names
+
+def descendants(node, type):
+    "List the AST nodes of a type anywhere beneath a node"
+    found = []
+    pending = [node]
+    while pending:
+        n = pending.pop()
+        if isinstance(n, type):
+            found.append(n)
+        pending.extend(child_nodes(n))
+    return found
+
+def worst_effect(a, b):
+    return EFFECT_ORDER[max(EFFECT_ORDER.index(a), EFFECT_ORDER.index(b))]
+
+
+class EffectAnalysis:
+    """Build the call graph of a parsed program and classify its functions
+
+    Each FunctionDef is marked pure, nondeterministic (it reaches
+    random_int) or effectful (it reaches print). A function that may call
+    one of its parameters, as in generate(3, f), can have whatever effect
+    its caller passes in, so it's marked effectful. Functions that can't
+    be reached from main or from any test are marked unreachable.
+
+    As in Program, the first definition of a name is the one analyzed.
+    """
+    def __init__(self, prog):
+        self.prog = prog
+        self.objects = dict()
+        for o in prog:
+            if hasattr(o, 'name') and o.name not in self.objects:
+                self.objects[o.name] = o
+
+        self.calls = dict()
+        for name,o in self.objects.items():
+            self.calls[name] = references(o)
+
+        self.called_params = self._called_params()
+        self.effects = self._classify()
+        self.reachable = self._reach()
+        for name,o in self.objects.items():
+            if isinstance(o, FunctionDef):
+                o.effect = self.effects[name]
+                o.reachable = name in self.reachable
+
+    def _classify(self):
+        effects = dict()
+        for name in self.objects:
+            effects[name] = PURE
+        ## iterate until nothing changes so recursive cycles settle
+        changed = True
+        while changed:
+            changed = False
+            for name,called in self.calls.items():
+                effect = effects[name]
+                for c in called:
+                    effect = worst_effect(effect, self._effect_of(c, effects))
+                if effect != effects[name]:
+                    effects[name] = effect
+                    changed = True
+        ## a caller already references whatever function it passes in,
+        ## so only the function that calls its parameter needs marking
+        for name in self.called_params:
+            if self.called_params[name]:
+                effects[name] = EFFECTFUL
+        return effects
+
+    def _called_params(self):
+        "Find the positions of the parameters that each function may call"
+        functions = [(name, o) for name, o in self.objects.items()
+            if isinstance(o, FunctionDef)]
+        called = dict((name, set()) for name, o in functions)
+        changed = True
+        while changed:
+            changed = False
+            for name, f in functions:
+                sources = self._param_sources(f)
+                found = set(called[name])
+                for call in descendants(f, FunctionCall):
+                    for i, arg in enumerate(call.args):
+                        if self._calls_arg(call.name, i, called):
+                            for r in references(arg):
+                                found.update(sources.get(r, ()))
+                if found != called[name]:
+                    called[name] = found
+                    changed = True
+        return called
+
+    def _calls_arg(self, name, i, called):
+        "Whether a call to name may call its argument at position i"
+        o = self.objects.get(name)
+        if o is not None:
+            return i in called.get(name, ())
+        return name == 'generate' and i == 1
+
+    @staticmethod
+    def _param_sources(f):
+        "Map each local name to the parameter positions its value may hold"
+        sources = dict((a, set([i])) for i, a in enumerate(f.args))
+        assignments = descendants(f, AssignStmt)
+        changed = True
+        while changed:
+            changed = False
+            for a in assignments:
+                held = set()
+                for r in references(a.src):
+                    held.update(sources.get(r, ()))
+                for d in a.dst:
+                    if not held <= sources.get(d, set()):
+                        sources.setdefault(d, set()).update(held)
+                        changed = True
+        return sources
+
+    def _effect_of(self, name, effects):
+        if name in effects:
+            return effects[name]
+        if "builtin_%s" % name in globals():
+            return BUILTIN_EFFECTS.get(name, EFFECTFUL)
+        ## a local variable, not a function
+        return PURE
+
+    def _reach(self):
+        pending = ['main']
+        for o in self.prog:
+            if isinstance(o, TestDef):
+                pending.extend(references(o))
+        reached = set()
+        while pending:
+            name = pending.pop()
+            if name in reached or name not in self.objects:
+                continue
+            reached.add(name)
+            pending.extend(self.calls[name])
+        return reached
+
+    def functions(self):
+        return [o for o in self.prog if isinstance(o, FunctionDef)
+            and self.objects[o.name] is o]
+
+    def unreachable(self):
+        return [f for f in self.functions() if not f.reachable]
+
+    def reachable_code(self):
+        "Drop functions and test data that nothing can reach"
+        code = []
+        for o in self.prog:
+            if isinstance(o, TestDef):
+                code.append(o)
+            elif o.name in self.reachable and self.objects[o.name] is o:
+                code.append(o)
+        return code
+
+    def report(self):
+        for f in self.functions():
+            kind = 'testfunc' if isinstance(f, TestFuncDef) else 'func'
+            print "%s %s: %s" % (kind, f.name, f.effect)
+        for f in self.unreachable():
+            print "unreachable: %s" % f.name
+
+
 
 class CallstackUnderflow(Exception):
     pass
@@ -743,34 +1518,99 @@ class CallFrame:
         self.result = None
         self.locals = dict()
 
-class Program:
-    def __init__(self, prog):
-        self.prog = prog
+
+class ExecutionContext:
+    """Mutable state for running code from a Program
+
+    A context has its own call stack and assertion count, so each thread
+    gets its own context while sharing the parsed program.
+    """
+    def __init__(self, program):
+        self.program = program
         self.callstack = []
+        self._assertions = 0
+        ## statement execution counters, only set while measuring coverage
+        self.counts = None
+        ## set while tracing, tracing is only true inside sampled cases
+        self.tracer = None
+        self.tracing = False
+        ## test data sets, evaluated once per run
+        self.datasets = dict()
+        ## execution limits, only set when running with a Budget
+        self.budget = None
 
     def call_function(self, fname, args):
+        if self.tracing:
+            self.tracer.begin(fname, 'call', {'args': args})
+            try:
+                return self._call_function(fname, args)
+            finally:
+                self.tracer.end(fname, 'call')
+        return self._call_function(fname, args)
+
+    def _call_function(self, fname, args):
         f = self._find_function(fname)
         if f.__class__ == BuiltinFunction:
+            if self.budget is not None:
+                self.budget.charge_builtin(fname, args)
             return f.func(*args)
+        depth = len(self.callstack)
         self._push_function(f, args)
-        result = self._run()
-        self.callstack.pop(-1)
-        return result
-
-    def run_test(self, test, givens):
+        try:
+            return self._run()
+        except RuntimeError, e:
+            ## runaway recursion is over budget even without a depth limit
+            if not str(e).startswith('maximum recursion depth'):
+                raise
+            raise BudgetExceeded("call depth over %d, the Python limit"
+                % depth)
+        finally:
+            ## also drop the frame when the call raised
+            del self.callstack[depth:]
+
+    def run_test(self, test, case):
         self._assertions = 0
+        depth = len(self.callstack)
         self.callstack.append(CallFrame(test))
-        for name,value in givens.items():
-            self.set_local(name, value)
-        result = self._run()
-        self.callstack.pop(-1)
+        try:
+            case.bind(self)
+            self._run()
+        finally:
+            del self.callstack[depth:]
         if self._assertions == 0:
             raise NoAssertionFailure()
 
-    def run_tests(self):
-        for s in self.prog:
-            if isinstance(s, TestDef):
-                s.run(self)
+    def begin_test(self, name):
+        if self.tracer is not None:
+            self.tracer.begin(name, 'test')
+
+    def end_test(self, name):
+        if self.tracer is not None:
+            self.tracer.end(name, 'test')
+
+    def start_case(self):
+        "Clear frames left by a failed case and restart the case budget"
+        del self.callstack[:]
+        if self.budget is not None:
+            self.budget.start_case()
+
+    def begin_case(self, name, index, args):
+        self.start_case()
+        if self.tracer is not None and self.tracer.sampled(index):
+            self.tracer.begin("%s[%d]" % (name, index), 'case', args)
+            self.tracing = True
+
+    def end_case(self, name, index):
+        if self.tracing:
+            self.tracing = False
+            self.tracer.end("%s[%d]" % (name, index), 'case')
+
+    def dataset(self, testdata):
+        data = self.datasets.get(testdata.name)
+        if data is None:
+            data = testdata.materialize(self)
+            self.datasets[testdata.name] = data
+        return data
 
     def _find_function(self, fname):
         f = self._find_object(fname)
@@ -779,25 +1619,7 @@ class Program:
         return f
 
     def _find_object(self, name, type=None):
-        if type is not None and not isinstance(type, string):
-            type = type.__name__
-        for o in self.prog:
-            if type is not None and o.__class__.__name != type:
-                continue
-            if not hasattr(o, 'name'):
-                continue
-            if o.name == name:
-                return o
-
-        builtin_name = "builtin_%s" % (name)
-        globs = self._find_object.__func__.func_globals
-        if builtin_name in globs:
-            f = globs[builtin_name]
-            if f.__class__.__name__ != 'function':
-                return None
-            return BuiltinFunction(f)
-
-        return None
+        return self.program.find_object(name, type)
 
     def _push_function(self, f, args):
         if args is None:
@@ -817,10 +1639,26 @@ class Program:
 
     def _run(self):
         frame = self.callstack[-1]
-        for i in frame.code:
-            i.execute(self)
+        budget = self.budget
+        if budget is not None:
+            ## there are no loops, so charge every statement up front
+            budget.left -= len(frame.code) + 1
+            if budget.left < 0 or len(self.callstack) > budget.max_depth:
+                budget.exceeded(len(self.callstack))
+        counts = self.counts
+        if counts is None:
+            for i in frame.code:
+                i.execute(self)
+        else:
+            for i in frame.code:
+                counts[i.sid] += 1
+                i.execute(self)
         return frame.result
 
+    def count(self, stmt):
+        if self.counts is not None:
+            self.counts[stmt.sid] += 1
+
     def set_result(self, value):
         self.callstack[-1].result = value
 
@@ -846,6 +1684,98 @@ class Program:
     def asserted(self):
         self._assertions += 1
 
+
+class Program:
+    """Parsed program code
+
+    The code is never modified while running, so one Program can be
+    shared between threads. Execution state lives in an
+    ExecutionContext, one per thread.
+    """
+    def __init__(self, prog):
+        self.prog = prog
+        self._index()
+        self._local = threading.local()
+
+    def _index(self):
+        self.objects = dict()
+        for o in self.prog:
+            if hasattr(o, 'name') and o.name not in self.objects:
+                self.objects[o.name] = o
+        self.statements = self._number_statements()
+
+    def update(self, prog):
+        """Splice newly parsed code into this program
+
+        Unlike running code, this changes the program in place, so no
+        other thread may be using it at the time.
+        """
+        self.prog[:] = prog
+        self._index()
+
+    def _number_statements(self):
+        statements = []
+        for o in self.prog:
+            if isinstance(o, FunctionDef):
+                statements.extend(o.code)
+            elif isinstance(o, RegularTestDef):
+                statements.extend(o.givens)
+                statements.extend(o.code)
+        for sid, stmt in enumerate(statements):
+            stmt.sid = sid
+        return statements
+
+    def context(self):
+        "Get the execution context for the current thread"
+        ctx = getattr(self._local, 'context', None)
+        if ctx is None:
+            ctx = ExecutionContext(self)
+            self._local.context = ctx
+        return ctx
+
+    def call_function(self, fname, args):
+        return self.context().call_function(fname, args)
+
+    def run_tests(self, shard=None, coverage=None, tracer=None, budget=None):
+        ctx = self.context()
+        results = TestResults(shard)
+        if coverage is not None:
+            ctx.counts = coverage.counts
+        ctx.tracer = tracer
+        ctx.datasets = dict()
+        ctx.budget = budget
+        if budget is not None:
+            budget.start_run()
+        try:
+            for s in self.prog:
+                if isinstance(s, TestDef):
+                    s.run(ctx, results)
+        finally:
+            ctx.counts = None
+            ctx.tracer = None
+            ctx.budget = None
+            if budget is not None:
+                budget.finish_run()
+        return results
+
+    def find_object(self, name, type=None):
+        if type is not None and not isinstance(type, basestring):
+            type = type.__name__
+        o = self.objects.get(name)
+        if o is not None:
+            if type is None or o.__class__.__name__ == type:
+                return o
+
+        builtin_name = "builtin_%s" % (name)
+        globs = globals()
+        if builtin_name in globs:
+            f = globs[builtin_name]
+            if f.__class__.__name__ != 'function':
+                return None
+            return BuiltinFunction(f)
+
+        return None
+
     def print_code(self):
         for s in self.prog:
             if s.__class__.__name__ == 'FunctionDef':
@@ -854,33 +1784,860 @@ class Program:
                 print "Unknown Statement: %s" % str(s)
 
 
+class Coverage:
+    """Statement execution counts for one run of a program
+
+    Counters live in an array indexed by statement id, so counting a
+    statement is one array increment.
+    """
+    def __init__(self, program):
+        self.source = None
+        self.lines = [s.lineno for s in program.statements]
+        self.counts = array.array('L', [0]) * len(self.lines)
+
+    def line_counts(self):
+        lines = dict()
+        for lineno, count in zip(self.lines, self.counts):
+            lines[lineno] = lines.get(lineno, 0) + count
+        return lines
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'source': self.source, 'lines': self.line_counts()}, f)
+
+    @staticmethod
+    def merge(filenames):
+        """Sum saved line counts from several runs of the same source
+
+        Returns the source file name and the combined line counts. Raises
+        a MergeError if the files were saved from different sources.
+        """
+        source = None
+        lines = dict()
+        for filename in filenames:
+            try:
+                with open(filename) as f:
+                    data = json.load(f)
+            except IOError, e:
+                raise MergeError("can't read %s: %s" % (filename, e.strerror))
+            if source is not None and data['source'] != source:
+                raise MergeError("%s is coverage of %s, not %s" % (filename
+                    , data['source'], source))
+            source = data['source']
+            for lineno, count in data['lines'].items():
+                lineno = int(lineno)
+                lines[lineno] = lines.get(lineno, 0) + count
+        return source, lines
+
+    @staticmethod
+    def annotate(source, lines, output):
+        "Write the source with the execution count of each statement line"
+        with open(source) as f:
+            code = f.readlines()
+        with open(output, 'w') as f:
+            for lineno, text in enumerate(code, 1):
+                if lineno not in lines:
+                    prefix = ''
+                elif lines[lineno] == 0:
+                    prefix = '!!!!!'
+                else:
+                    prefix = str(lines[lineno])
+                f.write("%7s  %s" % (prefix, text))
+        covered = len([c for c in lines.values() if c > 0])
+        print "%d of %d statement lines covered, see %s" % (covered
+            , len(lines), output)
+
+
+class Budget:
+    """Limits on the work done by each test case and by a whole run
+
+    Steps are statements plus calls. Any limit left as None is not
+    checked. The memory limit, in bytes, caps the whole process during
+    the run, so an allocation past it raises MemoryError in the case
+    that made it. The previous limit is put back by finish_run.
+
+    The step limits are folded into one countdown, left, so the
+    interpreter only has to decrement and compare it.
+
+    Each Testoy call takes several Python frames, so start_run raises
+    the Python recursion limit to fit the depth limit. Depths that
+    would need more than MAX_RECURSION frames raise ValueError.
+    """
+    ## Python frames used by one call, a few more than a plain call takes
+    FRAMES_PER_CALL = 8
+    ## deeper than this can overflow the C stack and crash the process
+    MAX_RECURSION = 12000
+
+    def __init__(self, case_steps=None, run_steps=None, depth=None
+            , memory=None):
+        if depth is not None and (depth < 1
+                or self.recursion_for(depth) > self.MAX_RECURSION):
+            raise ValueError("call depth must be from 1 to %d"
+                % self.deepest())
+        self.case_steps = case_steps
+        self.run_steps = run_steps
+        self.depth = depth
+        self.memory = memory
+        self.max_depth = sys.maxint if depth is None else depth
+        self.saved_memory = None
+        self.saved_recursion = None
+        self.reset()
+
+    @classmethod
+    def recursion_for(cls, depth):
+        ## the usual limit is left for the code around the calls
+        return sys.getrecursionlimit() + depth * cls.FRAMES_PER_CALL
+
+    @classmethod
+    def deepest(cls):
+        return (cls.MAX_RECURSION - sys.getrecursionlimit()) \
+            / cls.FRAMES_PER_CALL
+
+    def reset(self):
+        self.run_left = sys.maxint if self.run_steps is None else self.run_steps
+        self.case_start = self.left = 0
+        self.start_case()
+
+    def start_run(self):
+        self.reset()
+        if self.depth is not None:
+            self.saved_recursion = sys.getrecursionlimit()
+            sys.setrecursionlimit(self.recursion_for(self.depth))
+        if self.memory is not None:
+            self.saved_memory = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS
+                , (self.memory, self.saved_memory[1]))
+
+    def finish_run(self):
+        if self.saved_memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS, self.saved_memory)
+            self.saved_memory = None
+        if self.saved_recursion is not None:
+            sys.setrecursionlimit(self.saved_recursion)
+            self.saved_recursion = None
+
+    def start_case(self):
+        self.run_left -= self.case_start - self.left
+        self.left = self.run_left
+        if self.case_steps is not None:
+            self.left = min(self.left, self.case_steps)
+        self.case_start = self.left
+
+    def charge(self, steps, depth):
+        self.left -= steps
+        if self.left < 0 or depth > self.max_depth:
+            self.exceeded(depth)
+
+    def exceeded(self, depth):
+        if depth > self.max_depth:
+            raise BudgetExceeded("call depth over %d" % self.depth)
+        if self.case_steps is not None and self.left < self.case_start \
+                - self.case_steps:
+            raise BudgetExceeded("case over %d steps" % self.case_steps)
+        raise BudgetExceeded("run over %d steps" % self.run_steps)
+
+    def charge_builtin(self, name, args):
+        cost = BUILTIN_COSTS.get(name)
+        steps = 1
+        if cost is not None:
+            steps += cost(*args)
+        self.charge(steps, 0)
+
+
+class Tracer:
+    """Begin and end events for tests, cases and calls
+
+    Events go into a ring buffer allocated up front, so a long run keeps
+    only the most recent events instead of growing without bound. Only
+    every nth case is traced, along with the calls made inside it.
+    """
+    def __init__(self, size=1000000, sample=1):
+        self.events = [None] * size
+        self.size = size
+        self.sample = sample
+        self.written = 0
+        self.start = time.time()
+        self.tid = threading.current_thread().ident
+
+    def sampled(self, case):
+        return case % self.sample == 0
+
+    def begin(self, name, cat, args=None):
+        self.events[self.written % self.size] = ('B', name, cat, time.time()
+            , args)
+        self.written += 1
+
+    def end(self, name, cat):
+        self.events[self.written % self.size] = ('E', name, cat, time.time()
+            , None)
+        self.written += 1
+
+    def ordered_events(self):
+        if self.written <= self.size:
+            return self.events[:self.written]
+        first = self.written % self.size
+        return self.events[first:] + self.events[:first]
+
+    def save(self, filename):
+        "Write the events in Chrome trace-event format"
+        trace = []
+        depth = 0
+        for phase, name, cat, ts, args in self.ordered_events():
+            if phase == 'B':
+                depth += 1
+            elif depth == 0:
+                ## its begin event was overwritten in the ring
+                continue
+            else:
+                depth -= 1
+            event = {'ph': phase, 'name': name, 'cat': cat, 'pid': 1
+                , 'tid': self.tid, 'ts': (ts - self.start) * 1000000}
+            if isinstance(args, Case):
+                args = args.values()
+            if args is not None:
+                event['args'] = args
+            trace.append(event)
+        dropped = max(0, self.written - self.size)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'
+                , 'otherData': {'dropped_events': dropped}}, f, default=repr)
+
+
+_lexer = None
+_parser = None
+_parser_lock = threading.Lock()
+
+def parse_program(input, lineno=1):
+    "Parse program source into a list of top level definitions"
+    global _parser
+    ## the lexer and parser keep state while parsing, so one at a time
+    with _parser_lock:
+        global _lexer
+        if _parser is None:
+            _lexer = lex.lex()
+            _parser = yacc.yacc()
+        ## a parse that failed inside a string leaves the lexer in it
+        global STR_LITERAL
+        STR_LITERAL = ''
+        _lexer.begin('INITIAL')
+        _lexer.lineno = lineno
+        return _parser.parse(input, lexer=_lexer)
+
+
+BLOCK_KEYWORDS = set(['func', 'testfunc', 'test', 'puretest', 'purefail'
+    , 'testdata'])
+
+block_re = re.compile(r'^[ \t]*(?:%s)\b.*\n(?:.*\n)*?[ \t]*end[ \t]*\n'
+    % '|'.join(BLOCK_KEYWORDS), re.M)
+
+def split_blocks(input):
+    """Split program source into top level blocks
+
+    Returns a (lineno, text) pair for each block from its opening keyword
+    through its end line. Blank lines and comments between blocks are
+    dropped. Any other stray line becomes a block of its own so the
+    parser can report it.
+    """
+    if not input.endswith('\n'):
+        input += '\n'
+    blocks = []
+    pos = 0
+    lineno = 1
+    for m in block_re.finditer(input):
+        lineno = stray_blocks(input[pos:m.start()], lineno, blocks)
+        blocks.append((lineno, m.group()))
+        lineno += m.group().count('\n')
+        pos = m.end()
+    stray_blocks(input[pos:], lineno, blocks)
+    return blocks
+
+def stray_blocks(text, lineno, blocks):
+    """Add blocks for the lines found between complete blocks
+
+    Returns the line number following the text.
+    """
+    lines = text.splitlines(True)
+    for offset, line in enumerate(lines):
+        words = line.split()
+        if not words or words[0] == '##':
+            continue
+        elif words[0] in BLOCK_KEYWORDS:
+            ## a block missing its end runs to the end of the text
+            blocks.append((lineno + offset, ''.join(lines[offset:])))
+            break
+        else:
+            blocks.append((lineno + offset, line))
+    return lineno + len(lines)
+
+## numbers can't give up digits, or 124 could be read as 1 and 24
+LITERAL = r'-?\d+(?!\d)|"[^"\n]*"'
+literal_re = re.compile(LITERAL)
+table_header_re = re.compile(
+    r'(testdata)\s+([a-z][a-zA-Z_0-9]*)\s+provide\s*$'
+    r'|(puretest|purefail)\s+([a-z][a-zA-Z_0-9]*)\s+given\s*$')
+table_row_res = {
+    'testdata': re.compile(r'\s*(?:(?:%s)\s*)+$' % LITERAL),
+    'puretest': re.compile(r'\s*(?:%s)(?:\s*->\s*(?:%s))+\s*$'
+        % (LITERAL, LITERAL)),
+}
+table_row_res['purefail'] = table_row_res['puretest']
+
+def literal_values(line):
+    values = []
+    for token in literal_re.findall(line):
+        if token[0] == '"':
+            values.append(intern(token[1:-1]))
+        else:
+            values.append(int(token))
+    return values
+
+def parse_table_row(kind, line, lineno):
+    "Parse one table row that holds real expressions with the full grammar"
+    if kind == 'testdata':
+        header = "testdata row provide\n"
+    else:
+        header = "%s row given\n" % kind
+    node = parse_program(header + line + "\nend\n", lineno - 1)[0]
+    if kind == 'testdata':
+        return node.data[0]
+    return node.cases[0]
+
+def load_table(lineno, text):
+    """Load a testdata, puretest or purefail block without the grammar
+
+    Rows of only literal numbers and strings become ConstRows straight
+    from a regular expression scan, and only the other rows go through
+    the parser. Returns None for anything that isn't a plain table,
+    including a block missing its end line, so the grammar reports it.
+    """
+    stripped = text.rstrip()
+    body_end = stripped.rfind('\n') + 1
+    if body_end == 0 or stripped[body_end:].strip() != 'end':
+        return None
+    header_end = text.index('\n') + 1
+    header = table_header_re.match(text, 0, header_end - 1)
+    if header is None or '##' in text:
+        return None
+    kind = header.group(1) or header.group(3)
+    name = header.group(2) or header.group(4)
+    if name in reserved:
+        return None
+    body = text[header_end:body_end]
+
+    columns = bulk_columns(kind, body)
+    if columns is not None and kind == 'testdata':
+        ## keep only the columns, there's nothing left to evaluate per row
+        table = TestDataDef(name, [])
+        table.constant = TestDataSet([make_column(c) for c in columns]
+            , len(columns[0]))
+        return table
+    if columns is not None:
+        rows = map(ConstRow, zip(*columns))
+        constant = True
+    else:
+        constant = True
+        rows = []
+        literal_row = table_row_res[kind]
+        for offset, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            if literal_row.match(line):
+                rows.append(ConstRow(literal_values(line)))
+            else:
+                rows.append(parse_table_row(kind, line, lineno + offset))
+                constant = False
+    if not rows:
+        return None
+
+    if kind == 'puretest':
+        return PureTestDef(name, rows)
+    if kind == 'purefail':
+        return PureFailureDef(name, rows)
+    table = TestDataDef(name, rows)
+    if constant:
+        table.constant = TestDataSet.from_rows([list(r) for r in rows])
+    return table
+
+_bulk_res = dict()
+
+def bulk_columns(kind, body):
+    """Scan a table body in one pass when every row is literals of one width
+
+    Returns a list of values for each column, or None if the body doesn't
+    qualify.
+    """
+    first = body.lstrip().split('\n', 1)[0]
+    if not table_row_res[kind].match(first):
+        return None
+    width = len(literal_re.findall(first))
+    row_re = _bulk_res.get((kind, width))
+    if row_re is None:
+        sep = r'[ \t]*' if kind == 'testdata' else r'[ \t]*->[ \t]*'
+        row_re = re.compile(r'[ \t]*(?:%s)(?:%s(?:%s)){%d}[ \t]*\n'
+            % (LITERAL, sep, LITERAL, width - 1))
+        _bulk_res[(kind, width)] = row_re
+    ## every row is well formed if removing them leaves only blank lines
+    if row_re.sub('', body).strip():
+        return None
+
+    tokens = literal_re.findall(body)
+    if '"' in body:
+        values = literal_values(body)
+    else:
+        values = map(int, tokens)
+    return [values[i::width] for i in xrange(width)]
+
+def table_rows(table):
+    if isinstance(table, TestDataDef):
+        if table.constant is not None:
+            return [ConstRow(r) for r in table.constant]
+        return table.data
+    return table.cases
+
+def check_tables(input):
+    """Compare the table loader against the full grammar
+
+    Returns the line numbers of the table blocks that the grammar
+    rejects, or where a row loaded without the grammar doesn't match the
+    grammar's value for it.
+
+    >>> check_tables(open('table.testoy').read())
+    []
+    """
+    prog = Program([])
+    mismatches = []
+    for lineno, text in split_blocks(input):
+        table = load_table(lineno, text)
+        if table is None:
+            continue
+        try:
+            parsed = parse_program(text, lineno)[0]
+        except SystemExit:
+            ## p_error already reported it
+            mismatches.append(lineno)
+            continue
+        loaded_rows = table_rows(table)
+        parsed_rows = table_rows(parsed)
+        if table.__class__ is not parsed.__class__ \
+                or len(loaded_rows) != len(parsed_rows):
+            mismatches.append(lineno)
+            continue
+        for loaded, row in zip(loaded_rows, parsed_rows):
+            if isinstance(loaded, ConstRow) \
+                    and list(loaded) != evaluate_row(row, prog):
+                mismatches.append(lineno)
+                break
+    return mismatches
+
+def parse_block(lineno, text):
+    "Parse one top level block, using the table loader when it can"
+    table = load_table(lineno, text)
+    if table is not None:
+        return [table]
+    return parse_program(text, lineno)
+
+def shift_lines(node, delta):
+    "Move the source lines of every statement beneath a node"
+    pending = [node]
+    while pending:
+        n = pending.pop()
+        if isinstance(n, Statement):
+            n.lineno += delta
+        pending.extend(child_nodes(n))
+
+class IncrementalParser:
+    """Parser that only re-parses the top level blocks that changed
+
+    Each block is hashed, and a block whose text was seen in the
+    previous parse reuses its nodes, moved to its new line if needed.
+    """
+    def __init__(self):
+        self.blocks = dict()
+        self.parsed = 0
+        self.reused = 0
+
+    def parse(self, input):
+        previous = self.blocks
+        self.blocks = dict()
+        self.parsed = 0
+        self.reused = 0
+        prog = []
+        for lineno, text in split_blocks(input):
+            key = hashlib.sha1(text).digest()
+            cached = previous.get(key)
+            if cached:
+                old_lineno, nodes = cached.pop()
+                for n in nodes:
+                    shift_lines(n, lineno - old_lineno)
+                self.reused += 1
+            else:
+                nodes = parse_block(lineno, text)
+                self.parsed += 1
+            self.blocks.setdefault(key, []).append((lineno, nodes))
+            prog.extend(nodes)
+        return prog
+
+def load_program(program_file):
+    """Load a program file once for calling from any number of threads
+
+    >>> program = load_program('one.testoy')
+    >>> program.call_function('thrice', [4])
+    12
+    """
+    return Program(parse_file(program_file))
+
+def parse_file(program_file):
+    with open(program_file) as f:
+        input = f.read()
+    return IncrementalParser().parse(input)
+
+
+
+def watch(program_file):
+    "Re-run the tests each time the program file changes"
+    parser = IncrementalParser()
+    program = None
+    mtime = None
+    while True:
+        try:
+            current = os.stat(program_file).st_mtime
+        except OSError:
+            ## an editor may be replacing the file, look again shortly
+            current = None
+        if current is None or current == mtime:
+            time.sleep(0.5)
+            continue
+        try:
+            with open(program_file) as f:
+                input = f.read()
+        except IOError:
+            time.sleep(0.5)
+            continue
+        mtime = current
+        try:
+            progcode = parser.parse(input)
+        except SystemExit:
+            ## p_error already reported it, wait for the next edit
+            parser = IncrementalParser()
+            continue
+        except Exception, e:
+            print "parse error: %s" % e
+            parser = IncrementalParser()
+            continue
+        progcode = EffectAnalysis(progcode).reachable_code()
+        if program is None:
+            program = Program(progcode)
+        else:
+            program.update(progcode)
+        print "parsed %d blocks, reused %d" % (parser.parsed, parser.reused)
+        program.run_tests()
+
+
+class BuildError(Exception):
+    pass
+
+class PythonBuilder:
+    """Translate the FunctionDefs of a program into a Python module
+
+    Test functions and tests are left out. Builtins that the functions
+    use are copied into the module. Code that uses list values or =
+    gets its own copy of Vector, so the module doesn't need testoy or
+    ply.
+
+    Testoy names that would hide a Python keyword or builtin, or a name
+    the module itself uses, get a T_ prefix. Testoy names start with a
+    lower case letter, so the prefixed ones can't collide.
+    """
+    HEADER = "## generated by testoy.py build from %s, do not edit\n"
+    ## names defined by the generated module itself
+    MODULE_NAMES = set(['array', 'operator', 'random', 'make_column'
+        , 'Vector', 'vector_eq'])
+
+    def __init__(self, prog, source):
+        self.prog = prog
+        self.source = source
+        self.objects = dict()
+        for o in prog:
+            if hasattr(o, 'name'):
+                self.objects.setdefault(o.name, o)
+        self.builtins = set()
+        self.needs_vector = False
+
+    def module(self):
+        defs = []
+        for o in self.prog:
+            if o.__class__ is FunctionDef:
+                defs.append(self.function(o))
+
+        head = [self.HEADER % os.path.basename(self.source)]
+        if 'random_int' in self.builtins:
+            head.append("import random\n")
+        if 'generate' in self.builtins:
+            self.needs_vector = True
+        if self.needs_vector:
+            head.append("import array\nimport operator\n")
+            head.append("\n" + inspect.getsource(make_column))
+            head.append("\n" + inspect.getsource(Vector))
+            head.append("\n" + inspect.getsource(vector_eq))
+        for name in sorted(self.builtins):
+            head.append("\n" + inspect.getsource(globals()['builtin_' + name]))
+        return "\n".join(head + defs)
+
+    def function(self, f):
+        lines = ["\ndef %s(%s):" % (self.name(f.name)
+            , ", ".join(self.name(a) for a in f.args))]
+        lines.append("    _result = None")
+        for stmt in f.code:
+            lines.append("    " + self.statement(stmt))
+        lines.append("    return _result\n")
+        return "\n".join(lines)
+
+    def statement(self, stmt):
+        if isinstance(stmt, ReturnStmt):
+            ## return doesn't stop a Testoy function, the last one wins
+            return "_result = %s" % self.expr(stmt.expr)
+        if isinstance(stmt, AssignStmt):
+            names = ", ".join(self.name(d) for d in stmt.dst)
+            if len(stmt.dst) == 1:
+                return "%s = %s" % (names, self.expr(stmt.src))
+            return "%s = list(%s)" % (names, self.expr(stmt.src))
+        raise BuildError("can't build statement: %s" % stmt)
+
+    def expr(self, e):
+        if isinstance(e, (ConstIntExpr, StrLitExpr)):
+            return repr(e.value)
+        if isinstance(e, VarExpr):
+            return self.reference(e.name)
+        if isinstance(e, EqualExpr):
+            ## lists compare element by element, which == doesn't do
+            self.needs_vector = True
+            return "vector_eq(%s, %s)" % (self.expr(e.op1), self.expr(e.op2))
+        if isinstance(e, BinaryExpr):
+            return "(%s %s %s)" % (self.expr(e.op1)
+                , e.python_operator, self.expr(e.op2))
+        if isinstance(e, NegativeTerm):
+            return "(-%s)" % self.expr(e.x)
+        if isinstance(e, ListExpr):
+            self.needs_vector = True
+            return "Vector([%s])" % ", ".join(self.expr(i) for i in e.items)
+        if isinstance(e, IndexExpr):
+            return "%s[%s]" % (self.expr(e.list), self.expr(e.index))
+        if isinstance(e, FunctionCall):
+            return "%s(%s)" % (self.callee(e.name)
+                , ", ".join(self.expr(a) for a in e.args))
+        raise BuildError("can't build expression: %s" % e)
+
+    def reference(self, name):
+        ## same lookup order as ExecutionContext.get
+        if name in self.objects:
+            raise BuildError("%s can't be used as a value" % name)
+        if "builtin_%s" % name in globals():
+            self.builtins.add(name)
+            return "builtin_%s" % name
+        return self.name(name)
+
+    def callee(self, name):
+        f = self.objects.get(name)
+        if f is not None and f.__class__ is FunctionDef:
+            return self.name(name)
+        if f is not None:
+            raise BuildError("%s is not a plain function" % name)
+        if "builtin_%s" % name in globals():
+            self.builtins.add(name)
+            return "builtin_%s" % name
+        raise BuildError("Function doesn't exist: %s" % name)
+
+    @staticmethod
+    def name(name):
+        if keyword.iskeyword(name) or hasattr(__builtin__, name) \
+                or name in PythonBuilder.MODULE_NAMES \
+                or name.startswith('builtin_'):
+            return 'T_' + name
+        return name
+
+def build(program_file, output=None):
+    """Write a Python module for the functions in a program file
+
+    The module is byte compiled, then the program's puretest and purefail
+    tables are run against both the module and the interpreter. Returns
+    the number of cases where the two disagree.
+    """
+    if output is None:
+        output = os.path.splitext(program_file)[0] + '.py'
+    if os.path.exists(output):
+        with open(output) as f:
+            if not f.readline().startswith(PythonBuilder.HEADER[:24]):
+                raise BuildError("won't overwrite %s" % output)
+
+    with open(program_file) as f:
+        input = f.read()
+    progcode = IncrementalParser().parse(input)
+    builder = PythonBuilder(progcode, program_file)
+    with open(output, 'w') as f:
+        f.write(builder.module())
+    py_compile.compile(output, doraise=True)
+    print "built %s" % output
+
+    module_name = os.path.splitext(os.path.basename(output))[0]
+    try:
+        module = imp.load_source(module_name, output)
+    except Exception, e:
+        raise BuildError("can't load %s: %s" % (output, e))
+    return check_build(Program(progcode), module)
+
+def check_build(program, module):
+    ctx = program.context()
+    mismatches = 0
+    for t in program.prog:
+        if not isinstance(t, (PureTestDef, PureFailureDef)):
+            continue
+        if program.objects.get(t.function).__class__ is not FunctionDef:
+            continue
+        built = getattr(module, PythonBuilder.name(t.function), None)
+        for values in t.cases:
+            values = evaluate_row(values, ctx)
+            if isinstance(t, PureTestDef):
+                values = values[0:-1]
+            expected = outcome_of(ctx.call_function, t.function, values)
+            ctx.start_case()
+            ## converting the arguments can fail too, count it as an error
+            actual = outcome_of(lambda name, args: built(
+                *[built_value(module, v) for v in args]), t.function, values)
+            if expected != actual:
+                print "%s(%s): interpreter %s, built %s" % (t.function
+                    , ", ".join(repr(v) for v in values), expected, actual)
+                mismatches += 1
+    print "%d mismatches between interpreter and build" % mismatches
+    return mismatches
+
+def built_value(module, value):
+    "Hand a list to a built module as that module's own Vector"
+    if value.__class__ is Vector and hasattr(module, 'Vector'):
+        return module.Vector(value.items)
+    return value
+
+def outcome_of(call, name, args):
+    try:
+        return repr(call(name, args))
+    except Exception, e:
+        return "error"
+
+
+def int_option(options, name):
+    if name not in options:
+        return None
+    return int(options[name])
 
 def check_args():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], ''
+            , ['shard=', 'results=', 'coverage=', 'trace=', 'trace-size='
+            , 'trace-sample=', 'max-steps=', 'max-run-steps=', 'max-depth='
+            , 'max-memory=', 'output='])
+    except getopt.GetoptError, e:
+        print e
+        exit(-1)
+    options = dict((o[2:], v) for o,v in opts)
+
     cmd = 'x'
-    if len(sys.argv) == 3:
-        cmd = sys.argv[1]
-        program_file = sys.argv[2]
-    elif len(sys.argv) == 2:
-        program_file = sys.argv[1]
+    if len(args) >= 2:
+        cmd = args[0]
+        program_files = args[1:]
+    elif len(args) == 1:
+        program_files = args
     else:
         print "missing program file"
         exit(-1)
-    return (cmd, program_file)
+    return (cmd, program_files, options)
 
 
 def main():
-    lex.lex()
-
-    cmd, program_file = check_args()
+    cmd, program_files, options = check_args()
+    program_file = program_files[0]
 
-    if program_file is not None and cmd == 'test':
-        parser = yacc.yacc()
+    if cmd == 'test':
+        shard = None
+        if 'shard' in options:
+            try:
+                shard = Shard.parse(options['shard'])
+            except ValueError, e:
+                print e
+                exit(-1)
+        progcode = parse_file(program_file)
+        if 'coverage' not in options:
+            ## coverage has to report the unreachable code as unrun
+            progcode = EffectAnalysis(progcode).reachable_code()
+        program = Program(progcode)
+        coverage = None
+        if 'coverage' in options:
+            coverage = Coverage(program)
+            coverage.source = program_file
+        tracer = None
+        if 'trace' in options:
+            size = int(options.get('trace-size', 1000000))
+            sample = int(options.get('trace-sample', 1))
+            if size < 1 or sample < 1:
+                print "--trace-size and --trace-sample must be at least 1"
+                exit(-1)
+            tracer = Tracer(size, sample)
+        budget = None
+        limits = ['max-steps', 'max-run-steps', 'max-depth', 'max-memory']
+        if [l for l in limits if l in options]:
+            memory = options.get('max-memory')
+            if memory is not None:
+                ## given in megabytes
+                memory = int(memory) * 1024 * 1024
+            try:
+                budget = Budget(int_option(options, 'max-steps')
+                    , int_option(options, 'max-run-steps')
+                    , int_option(options, 'max-depth'), memory)
+            except ValueError, e:
+                print "--max-depth %s" % e
+                exit(-1)
+        results = program.run_tests(shard, coverage, tracer, budget)
+        if tracer is not None:
+            tracer.save(options['trace'])
+        if 'results' in options:
+            results.save(options['results'])
+        if coverage is not None:
+            coverage.save(options['coverage'])
+            Coverage.annotate(program_file, coverage.line_counts()
+                , program_file + ',cover')
+        if results.failed():
+            exit(1)
+    elif cmd == 'merge':
+        try:
+            results = TestResults.merge(program_files)
+        except MergeError, e:
+            print "merge error: %s" % e
+            exit(1)
+        results.report()
+        if results.failed():
+            exit(1)
+    elif cmd == 'build':
+        try:
+            mismatches = build(program_file, options.get('output'))
+        except BuildError, e:
+            print "build error: %s" % e
+            exit(1)
+        if mismatches:
+            exit(1)
+    elif cmd == 'watch':
+        watch(program_file)
+    elif cmd == 'cover':
+        try:
+            source, lines = Coverage.merge(program_files)
+        except MergeError, e:
+            print "merge error: %s" % e
+            exit(1)
+        Coverage.annotate(source, lines, source + ',cover')
+    elif cmd == 'analyze':
         with open(program_file) as f:
             input = f.read()
-        progcode = parser.parse(input)
-        program = Program(progcode)
-        program.run_tests()
-    elif program_file is not None and cmd == 'lex':
+        progcode = IncrementalParser().parse(input)
+        EffectAnalysis(progcode).report()
+    elif cmd == 'lex':
+        lex.lex()
         with open(program_file) as f:
             input = f.read()
         lex.input(input)
@@ -889,11 +2646,8 @@ def main():
             if not tok:
                 break
             print tok
-    elif program_file is not None:
-        parser = yacc.yacc()
-        with open(program_file) as f:
-            input = f.read()
-        progcode = parser.parse(input)
+    else:
+        progcode = EffectAnalysis(parse_file(program_file)).reachable_code()
         program = Program(progcode)
         program.call_function('main', [5])
 